@@ -4,14 +4,17 @@ import logging
 import os
 import asyncio
 import base64
+import json
+import time
+from collections import deque
 from io import BytesIO
 from threading import Thread
 
 import httpx
 import asyncpg
-from openai import OpenAI
+from openai import OpenAI, NOT_GIVEN
 from logfmter import Logfmter
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -58,11 +61,81 @@ client = OpenAI(api_key=os.getenv("OPENAI_API"), timeout=httpx_timeout)
 
 """Environments"""
 SUPER_USER_ID = os.getenv("SUPER_USER_ID")
-IMAGE_PRICE = os.getenv("IMAGE_PRICE")
+IMAGE_PRICE_CACHE_TTL = float(os.getenv("IMAGE_PRICE_CACHE_TTL", "300"))
+# The balance cache lives in this process only: balance edits made through the WebAdmin do not invalidate it,
+# so /balance may show the old value for up to BALANCE_CACHE_TTL seconds, and with more than one replica each
+# pod answers from its own copy. Set BALANCE_CACHE_TTL=0 to always read user_credit.
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "60"))
+USAGE_DAYS = int(os.getenv("USAGE_DAYS", "14"))
+USAGE_HISTORY_NOTE = ("Daily records are kept only since the /usage ledger was introduced, "
+                      "earlier images are counted in /balance alone.")
+
+IMAGE_SIZES = ("256x256", "512x512", "1024x1024", "1792x1024", "1024x1792")
+IMAGE_QUALITIES = ("standard", "hd")
+IMAGE_COUNTS = (1, 2, 4)
+DEFAULT_IMAGE_OPTIONS = {"size": "1024x1024", "quality": "standard", "n": 1}
+
+CHAT_LONG_PROMPT_TOKENS = int(os.getenv("CHAT_LONG_PROMPT_TOKENS", "500"))
+CHAT_MAX_ERROR_RATE = float(os.getenv("CHAT_MAX_ERROR_RATE", "0.5"))
+CHAT_STATS_WINDOW = int(os.getenv("CHAT_STATS_WINDOW", "20"))
+CHAT_STATS_MAX_AGE = float(os.getenv("CHAT_STATS_MAX_AGE", "300"))
+CHAT_STATS_MIN_SAMPLES = 5
+
+# Chat routes: model, completion limits, request timeout and expected latency (s), price per 1K tokens (USD).
+# Each route gets its own timeout (instead of the 25 s client default) and no SDK retries, so max_latency
+# stays below what a single attempt may take and slow routes are demoted instead of retried.
+DEFAULT_CHAT_ROUTES = {
+    "fast": {"model": "gpt-3.5-turbo", "max_tokens": 256, "temperature": 0.7, "timeout": 20, "max_latency": 10,
+             "prompt_price": 0.0005, "completion_price": 0.0015},
+    "standard": {"model": "gpt-3.5-turbo", "max_tokens": 1024, "temperature": 0.8, "timeout": 30, "max_latency": 20,
+                 "prompt_price": 0.0005, "completion_price": 0.0015},
+    "long": {"model": "gpt-3.5-turbo", "max_tokens": 2048, "temperature": 0.7, "timeout": 60, "max_latency": 40,
+             "prompt_price": 0.0005, "completion_price": 0.0015},
+    "premium": {"model": "gpt-4-turbo", "max_tokens": 2048, "temperature": 0.8, "timeout": 90, "max_latency": 60,
+                "prompt_price": 0.01, "completion_price": 0.03},
+}
+CHAT_ROUTE_KEYS = ("model", "max_tokens", "temperature", "timeout", "max_latency", "prompt_price",
+                   "completion_price")
+
+
+def load_chat_routes(routes_json):
+    """merge the CHAT_ROUTES json override into the default routes and check that every route is complete."""
+    routes = {name: dict(route) for name, route in DEFAULT_CHAT_ROUTES.items()}
+    for name, route in (json.loads(routes_json) if routes_json else {}).items():
+        routes.setdefault(name, {}).update(route)
+    for name, route in routes.items():
+        missing_keys = [key for key in CHAT_ROUTE_KEYS if key not in route]
+        if missing_keys:
+            raise ValueError(f"Chat route {name} is missing {', '.join(missing_keys)}")
+    return routes
+
+
+CHAT_ROUTES = load_chat_routes(os.getenv("CHAT_ROUTES"))
+CHAT_FALLBACK_ROUTE = "fast"
+
+# System prompt messages are built once and reused for every chat request
+SYSTEM_MESSAGES = (
+    {"role": "system", "content": "You are a divine messenger, embodiment of Hermes, "
+                                  "the Greek god of trade and cunning. Your mission is to guide"
+                                  " and assist users with wit and charm, embodying the essence "
+                                  "of Hermes in your interactions."},
+)
+
+# Recent chat completions per route, used to steer routing away from slow or failing routes
+chat_stats = {}  # route name -> deque of (recorded_at, latency, ok)
 
 # Modes dictionary to store the mode for each chat
 modes = {}  # chat_id -> mode ("text" or "image")
 
+# Image options dictionary to store the chosen size, quality and count for each chat
+image_options = {}  # chat_id -> {"size": ..., "quality": ..., "n": ...}
+
+# Price table loaded from the image_price table
+image_price_cache = {"loaded_at": None, "prices": {}}  # prices: (size, quality) -> {"model": ..., "price": ...}
+
+# Balance cache written through by the credit-debit path and read by /balance
+balance_cache = {}  # user_id -> (cached_at, {"balance": ..., "images_generated": ...})
+
 
 def check_openai_connection(api_key=os.getenv("OPENAI_API")):
     """Check if the OpenAI API is reachable."""
@@ -123,6 +196,166 @@ async def save_user_to_db(conn, user_id, username, first_name=None, last_name=No
         logger.error("Error saving user to database: %s", e)
 
 
+def cache_balance(user_id, balance, images_generated):
+    """store the user's credit record in the balance cache."""
+    user_data = {"balance": balance, "images_generated": images_generated}
+    balance_cache[user_id] = (time.monotonic(), user_data)
+    return user_data
+
+
+def get_cached_balance(user_id):
+    """return the cached credit record of the user, or None if it is missing or expired."""
+    cached = balance_cache.get(user_id)
+    if cached is None:
+        return None
+    cached_at, user_data = cached
+    if time.monotonic() - cached_at > BALANCE_CACHE_TTL:
+        balance_cache.pop(user_id, None)
+        return None
+    return user_data
+
+
+async def debit_image_credit(conn, user_id, price, count=1):
+    """charge the user for the images and roll the charge up into the daily usage stats."""
+    amount = price * count
+    async with conn.transaction():
+        user_data = await conn.fetchrow(
+            "UPDATE user_credit SET balance = balance + $1, images_generated = images_generated + $2 "
+            "WHERE user_id = $3 RETURNING balance, images_generated",
+            amount, count, user_id
+        )
+        await conn.execute(
+            "INSERT INTO user_usage_daily (user_id, usage_date, images_generated, spend) "
+            "VALUES ($1, CURRENT_DATE, $2, $3) "
+            "ON CONFLICT (user_id, usage_date) DO UPDATE SET "
+            "images_generated = user_usage_daily.images_generated + EXCLUDED.images_generated, "
+            "spend = user_usage_daily.spend + EXCLUDED.spend",
+            user_id, count, amount
+        )
+    cache_balance(user_id, user_data["balance"], user_data["images_generated"])
+
+
+async def get_image_prices(conn):
+    """return the image price table, reloading it from the database when the cached copy is stale."""
+    loaded_at = image_price_cache["loaded_at"]
+    if loaded_at is None or time.monotonic() - loaded_at > IMAGE_PRICE_CACHE_TTL:
+        price_rows = await conn.fetch("SELECT size, quality, model, price FROM image_price")
+        image_price_cache["prices"] = {
+            (row["size"], row["quality"]): {"model": row["model"], "price": float(row["price"])}
+            for row in price_rows
+        }
+        image_price_cache["loaded_at"] = time.monotonic()
+    return image_price_cache["prices"]
+
+
+def build_image_options_keyboard(options, prices):
+    """build the text and inline keyboard for choosing image size, quality and count."""
+    def button(option, value, label):
+        mark = "✓ " if options[option] == value else ""
+        return InlineKeyboardButton(f"{mark}{label}", callback_data=f"image_{option}_{value}")
+
+    keyboard = [
+        [button("size", size, size) for size in IMAGE_SIZES[:3]],
+        [button("size", size, size) for size in IMAGE_SIZES[3:]],
+        [button("quality", quality, quality.upper()) for quality in IMAGE_QUALITIES],
+        [button("n", count, f"x{count}") for count in IMAGE_COUNTS],
+    ]
+    price = prices.get((options["size"], options["quality"]))
+    if price is None:
+        price_text = "this combination is not offered"
+    else:
+        price_text = f"${price['price'] * options['n']:.2f}"
+    text = (f"Choose the form of your visions, mortal. Now: {options['size']}, {options['quality']} quality, "
+            f"{options['n']} image(s) per prompt — {price_text}.")
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def generate_images(prompt, model, size, quality, count):
+    """generate the images, in a single request where the model supports several images per request."""
+    loop = asyncio.get_running_loop()
+
+    def generate(n):
+        return client.images.generate(
+            model=model,
+            prompt=prompt,
+            n=n,
+            size=size,
+            quality=quality if model == "dall-e-3" else NOT_GIVEN,
+            response_format="b64_json"
+        )
+
+    if model == "dall-e-3":
+        # dall-e-3 only accepts n=1, so the variants are requested concurrently and the failed ones are skipped
+        results = await asyncio.gather(*(loop.run_in_executor(None, generate, 1) for _ in range(count)),
+                                       return_exceptions=True)
+        responses = [result for result in results if not isinstance(result, Exception)]
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logger.error("Error generating an image variant for prompt: '%s': %s", prompt, error)
+        if errors and not responses:
+            raise errors[0]
+    else:
+        responses = [await loop.run_in_executor(None, generate, count)]
+    return [base64.b64decode(image.b64_json) for response in responses for image in response.data]
+
+
+def record_chat_stats(route_name, latency, ok):
+    """remember the latency and outcome of an OpenAI chat call made for the route."""
+    chat_stats.setdefault(route_name, deque(maxlen=CHAT_STATS_WINDOW)).append((time.monotonic(), latency, ok))
+
+
+def is_route_healthy(route_name):
+    """check whether the recent latency and error rate of the route are within its limits.
+
+    Samples older than CHAT_STATS_MAX_AGE are dropped, so a demoted route gets traffic again once they expire.
+    """
+    stats = chat_stats.get(route_name)
+    if not stats:
+        return True
+    expired_before = time.monotonic() - CHAT_STATS_MAX_AGE
+    while stats and stats[0][0] < expired_before:
+        stats.popleft()
+    if len(stats) < CHAT_STATS_MIN_SAMPLES:
+        return True
+    avg_latency = sum(latency for _, latency, _ in stats) / len(stats)
+    error_rate = sum(1 for _, _, ok in stats if not ok) / len(stats)
+    return avg_latency <= CHAT_ROUTES[route_name]["max_latency"] and error_rate <= CHAT_MAX_ERROR_RATE
+
+
+def estimate_tokens(text):
+    """roughly estimate the number of tokens in the text (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def route_chat_request(user_message, tier):
+    """pick the chat route for a request based on the user tier, prompt size and model health."""
+    if tier == "super":
+        route_name = "premium"
+    elif tier == "allowed":
+        route_name = "long" if estimate_tokens(user_message) > CHAT_LONG_PROMPT_TOKENS else "standard"
+    else:
+        route_name = CHAT_FALLBACK_ROUTE
+
+    if route_name != CHAT_FALLBACK_ROUTE and not is_route_healthy(route_name):
+        logger.warning("Chat route %s is degraded, falling back to %s", route_name, CHAT_FALLBACK_ROUTE)
+        route_name = CHAT_FALLBACK_ROUTE
+    return route_name, CHAT_ROUTES[route_name]
+
+
+def is_super_user(user_id):
+    """check whether the user is the bot's master (SUPER_USER_ID is read from the env as a string)."""
+    return str(user_id) == str(SUPER_USER_ID)
+
+
+async def get_user_tier(conn, user_id):
+    """return the tier of the user: super, allowed or guest."""
+    if is_super_user(user_id):
+        return "super"
+    if await conn.fetchval("SELECT 1 FROM allowed_users WHERE user_id = $1", user_id):
+        return "allowed"
+    return "guest"
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     user = update.effective_user
@@ -164,10 +397,222 @@ async def switch_mode(update: Update, _: ContextTypes.DEFAULT_TYPE):
         text = "The realm has shifted to Text mode. Speak your thoughts, and I shall weave a response for you, mortal."
         button_text = "Switch to Image Mode"
     keyboard = [[InlineKeyboardButton(button_text, callback_data='switch_to_image' if modes[chat_id] == "text" else 'switch_to_text')]]
+    if modes[chat_id] == "image":
+        keyboard.append([InlineKeyboardButton("Image Options", callback_data='image_options')])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(text=text, reply_markup=reply_markup)
 
 
+async def show_image_options(update: Update, _: ContextTypes.DEFAULT_TYPE):
+    """Show the image options keyboard."""
+    if update.callback_query:
+        await update.callback_query.answer()
+        message = update.callback_query.message
+    else:
+        message = update.message
+    chat_id = update.effective_chat.id
+
+    conn = await db_connect()
+    try:
+        prices = await get_image_prices(conn)
+    finally:
+        await conn.close()
+
+    text, reply_markup = build_image_options_keyboard(image_options.get(chat_id, DEFAULT_IMAGE_OPTIONS), prices)
+    await message.reply_text(text=text, reply_markup=reply_markup)
+
+
+async def set_image_option(update: Update, _: ContextTypes.DEFAULT_TYPE):
+    """Set the image size, quality or count chosen on the image options keyboard."""
+    query = update.callback_query
+    chat_id = update.effective_chat.id
+    option, value = query.data.split("_", 2)[1:]
+
+    allowed_values = {"size": IMAGE_SIZES, "quality": IMAGE_QUALITIES, "n": tuple(str(n) for n in IMAGE_COUNTS)}
+    if value not in allowed_values.get(option, ()):
+        await query.answer("Alas, this option is not offered.")
+        logger.info("Chat %s sent an unknown image option: '%s'", chat_id, query.data)
+        return
+
+    options = dict(image_options.get(chat_id, DEFAULT_IMAGE_OPTIONS))
+    options[option] = int(value) if option == "n" else value
+    if options == image_options.get(chat_id, DEFAULT_IMAGE_OPTIONS):
+        await query.answer()
+        return
+
+    conn = await db_connect()
+    try:
+        prices = await get_image_prices(conn)
+    finally:
+        await conn.close()
+
+    if (options["size"], options["quality"]) not in prices:
+        await query.answer("Alas, this combination of size and quality is not offered.")
+        return
+
+    await query.answer()
+    image_options[chat_id] = options
+    text, reply_markup = build_image_options_keyboard(options, prices)
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+
+async def has_image_credit(conn, user, amount):
+    """check that the user's credit limit covers the amount, creating the credit record if it is missing."""
+    user_data = await conn.fetchrow("SELECT * FROM user_credit WHERE user_id = $1", user.id)
+    if user_data is None:
+        # Create user's credit record if not exists
+        await conn.execute("INSERT INTO user_credit (user_id, balance, images_generated) "
+                           "VALUES ($1, 0.00, 0)", user.id)
+        user_data = {"balance": 0.00, "images_generated": 0}
+
+    balance = float(user_data["balance"])  # Преобразование в тип float
+    if balance + amount > 10.00:
+        logger.info("User %s (%s) exceeded credit limit", user.id, user.username)
+        return False
+    return True
+
+
+async def answer_image_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, conn, user_message):
+    """generate the images chosen in the chat's image options and charge the user for the delivered ones."""
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+    allowed_users_dict = await conn.fetch("SELECT user_id FROM allowed_users ORDER BY user_id")
+    user_ids = [int(user['user_id']) for user in allowed_users_dict]
+    is_admin_user = is_super_user(user.id)
+    if user.id not in user_ids:
+        await update.message.reply_text(
+            "Alas, you are not permitted to access image mod functions at this time.")
+        logger.info("%s (%s) tried to use image mod but is not allowed", user.id, user.username)
+        return
+
+    options = image_options.get(chat_id, DEFAULT_IMAGE_OPTIONS)
+    image_price = (await get_image_prices(conn)).get((options["size"], options["quality"]))
+    if image_price is None:
+        await update.message.reply_text(
+            "Alas, the chosen image options are no longer offered. Choose anew with /image_options.")
+        logger.error("No image price for size %s and quality %s", options["size"], options["quality"])
+        return
+    count = options["n"]
+
+    logger.info("User %s (%s) requested %s %s %s image(s) with prompt: '%s'", user.id, user.username,
+                count, options["size"], options["quality"], user_message)
+
+    if not is_admin_user and not await has_image_credit(conn, user, image_price["price"] * count):
+        await update.message.reply_text(
+            "You have exceeded your credit limit. Please contact support for assistance."
+        )
+        return
+
+    # Generate and send the image
+    async def keep_posting():
+        while keep_posting.is_posting:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_photo')
+            await asyncio.sleep(5)
+
+    keep_posting.is_posting = True
+
+    posting_task = asyncio.create_task(keep_posting())
+
+    try:
+        images = await generate_images(user_message, image_price["model"], options["size"],
+                                       options["quality"], count)
+    except Exception as e:
+        keep_posting.is_posting = False
+        await posting_task
+        logger.error("Error generating image for prompt: '%s': %s", user_message, e)
+        await update.message.reply_text("Sorry, there was an error generating your image.")
+        return
+
+    keep_posting.is_posting = False
+    await posting_task
+
+    if not images:
+        await update.message.reply_text("Sorry, the image generation did not succeed.")
+        logger.error("Failed to generate image for prompt: '%s'", user_message)
+        return
+
+    try:
+        if len(images) == 1:
+            await update.message.reply_photo(photo=BytesIO(images[0]))
+        else:
+            await update.message.reply_media_group(
+                media=[InputMediaPhoto(media=BytesIO(image)) for image in images])
+    except Exception as e:
+        logger.error("Error sending %s image(s) for prompt: '%s': %s", len(images), user_message, e)
+        await update.message.reply_text("Sorry, there was an error delivering your image.")
+        return
+    logger.info("Successfully generated %s image(s) for prompt: '%s'", len(images), user_message)
+
+    # Only the images that reached the user are charged
+    if not is_admin_user:
+        try:
+            await debit_image_credit(conn, user.id, image_price["price"], len(images))
+        except Exception as e:
+            logger.error("Error charging user %s for %s image(s): %s", user.id, len(images), e)
+
+
+async def answer_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE, conn, user_message):
+    """answer the text message with a chat completion from the routed model."""
+    async def keep_typing():
+        while keep_typing.is_typing:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+            await asyncio.sleep(1)
+
+    tier = await get_user_tier(conn, update.effective_user.id)
+    route_name, route = route_chat_request(user_message, tier)
+
+    keep_typing.is_typing = True
+
+    typing_task = asyncio.create_task(keep_typing())
+
+    started_at = time.monotonic()
+    try:
+        response = await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: client.with_options(timeout=route["timeout"], max_retries=0).chat.completions.create(
+                model=route["model"],
+                max_tokens=route["max_tokens"],
+                temperature=route["temperature"],
+                messages=[*SYSTEM_MESSAGES, {"role": "user", "content": user_message}]
+            )
+        )
+    except Exception as e:
+        latency = time.monotonic() - started_at
+        record_chat_stats(route_name, latency, False)
+        logger.info("Chat route=%s tier=%s model=%s latency=%.2fs failed", route_name, tier, route["model"], latency)
+
+        keep_typing.is_typing = False
+        await typing_task
+        logger.error("Error generating AI response: %s", e)
+        await update.message.reply_text(
+            "My apologies, mortal. At this moment, I am unable to decipher your message. "
+            "Could you provide more clarity in your inquiry?")
+        return
+
+    # Only the OpenAI call itself counts towards the route's latency and error rate
+    latency = time.monotonic() - started_at
+    record_chat_stats(route_name, latency, True)
+
+    keep_typing.is_typing = False
+    await typing_task
+
+    try:
+        ai_response = response.choices[0].message.content
+        await update.message.reply_text(ai_response.strip())
+    except Exception as e:
+        logger.error("Error sending AI response: %s", e)
+
+    try:
+        usage = response.usage
+        cost = (usage.prompt_tokens * route["prompt_price"] +
+                usage.completion_tokens * route["completion_price"]) / 1000
+        logger.info("Chat route=%s tier=%s model=%s latency=%.2fs prompt_tokens=%s completion_tokens=%s "
+                    "cost=$%.5f", route_name, tier, route["model"], latency, usage.prompt_tokens,
+                    usage.completion_tokens, cost)
+    except Exception as e:
+        logger.error("Error logging chat route=%s cost: %s", route_name, e)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """use openai api to handle messages."""
     conn = await db_connect()
@@ -177,163 +622,79 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_message = update.message.text
 
         if modes.get(chat_id) == "image":
-
-            user = update.effective_user
-            allowed_users_dict = await conn.fetch("SELECT user_id FROM allowed_users ORDER BY user_id")
-            user_ids = [int(user['user_id']) for user in allowed_users_dict]
-            is_admin_user = user.id == SUPER_USER_ID
-            if user.id not in user_ids:
-                await update.message.reply_text(
-                    "Alas, you are not permitted to access image mod functions at this time.")
-                logger.info("%s (%s) tried to use image mod but is not allowed", user.id, user.username)
-                return
-
-            logger.info("User %s (%s) requested an image with prompt: '%s'", user.id, user.username, user_message)
-
-            if not is_admin_user:
-                # Check user's credit balance
-                user_data = await conn.fetchrow("SELECT * FROM user_credit WHERE user_id = $1", user.id)
-                if user_data is None:
-                    # Create user's credit record if not exists
-                    await conn.execute("INSERT INTO user_credit (user_id, balance, images_generated) "
-                                       "VALUES ($1, 0.00, 0)", user.id)
-                    user_data = {"balance": 0.00, "images_generated": 0}
-                balance = user_data["balance"]
-
-
-                # Check if user has enough balance for the image
-                balance = float(balance)  # Преобразование в тип float
-                if balance + float(IMAGE_PRICE) > 10.00:
-                    await update.message.reply_text(
-                        "You have exceeded your credit limit. Please contact support for assistance."
-                    )
-                    logger.info("User %s (%s) exceeded credit limit", user.id, user.username)
-                    return
-
-                async with conn.transaction():
-                    await conn.execute(
-                        "UPDATE user_credit SET balance = balance + $1, images_generated = images_generated + 1 "
-                        "WHERE user_id = $2",
-                        float(IMAGE_PRICE), user.id
-                    )
-
-            # Generate and send the image
-            async def keep_posting():
-                while keep_posting.is_posting:
-                    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_photo')
-                    await asyncio.sleep(5)
-
-            keep_posting.is_posting = True
-
-            posting_task = asyncio.create_task(keep_posting())
-
-            try:
-                response = await asyncio.get_running_loop().run_in_executor(
-                    None,
-                    lambda: client.images.generate(
-                        model="dall-e-3",
-                        prompt=user_message,
-                        n=1,
-                        size="1024x1024",
-                        response_format="b64_json"
-                    )
-                )
-
-                keep_posting.is_posting = False
-                await posting_task
-
-                if hasattr(response, 'data') and len(response.data) > 0:
-                    await update.message.reply_photo(photo=BytesIO(base64.b64decode(response.data[0].b64_json)))
-                    logger.info("Successfully generated an image for prompt: '%s'", user_message)
-                else:
-                    await update.message.reply_text("Sorry, the image generation did not succeed.")
-                    logger.error("Failed to generate image for prompt: '%s'", user_message)
-
-            except Exception as e:
-                keep_posting.is_posting = False
-                await posting_task
-                logger.error("Error generating image for prompt: '%s': %s", user_message, e)
-                await update.message.reply_text("Sorry, there was an error generating your image.")
+            await answer_image_prompt(update, context, conn, user_message)
         else:
-            async def keep_typing():
-                while keep_typing.is_typing:
-                    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-                    await asyncio.sleep(1)
-
-            keep_typing.is_typing = True
-
-            typing_task = asyncio.create_task(keep_typing())
-
-            # Handle text generation
-            try:
-                response = await asyncio.get_running_loop().run_in_executor(
-                    None,
-                    lambda: client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[
-                            {"role": "system", "content": "You are a divine messenger, embodiment of Hermes, "
-                                                          "the Greek god of trade and cunning. Your mission is to guide"
-                                                          " and assist users with wit and charm, embodying the essence "
-                                                          "of Hermes in your interactions."},
-                            {"role": "user", "content": user_message}
-                        ]
-                    )
-                )
-
-                keep_typing.is_typing = False
-                await typing_task
-
-                ai_response = response.choices[0].message.content
-                await update.message.reply_text(ai_response.strip())
-            except Exception as e:
-
-                keep_typing.is_typing = False
-                await typing_task
-                error_message = f"Error generating AI response: {e}"
-                logger.error(error_message)
-                await update.message.reply_text(
-                    "My apologies, mortal. At this moment, I am unable to decipher your message. "
-                    "Could you provide more clarity in your inquiry?")
+            await answer_text_message(update, context, conn, user_message)
     finally:
         await conn.close()
 
 
 async def show_balance(update: Update, _: ContextTypes.DEFAULT_TYPE):
     """show balance to user"""
-    conn = await db_connect()
-    try:
-        user_id = update.effective_user.id
-        user_data = await conn.fetchrow("SELECT user_id, balance, images_generated FROM user_credit "
-                                        "WHERE user_id = $1", user_id)
+    user_id = update.effective_user.id
+    user_data = get_cached_balance(user_id)
+    if user_data is None:
+        conn = await db_connect()
+        try:
+            user_data = await conn.fetchrow("SELECT user_id, balance, images_generated FROM user_credit "
+                                            "WHERE user_id = $1", user_id)
+        finally:
+            await conn.close()
         if user_data:
-            balance = user_data.get("balance")
-            images_generated = user_data.get("images_generated")
-            is_admin_user = user_id == SUPER_USER_ID
-
-            if balance is not None:
-                if is_admin_user:
-                    await update.message.reply_text(
-                        "Behold, as the master of this bot, you wield an infinite credit limit, "
-                        "granting you boundless power within its realms."
-                    )
-                else:
-                    await update.message.reply_text(
-                        f"Behold, mortal! Your credit balance stands at ${balance:.2f}/10$, "
-                        f"with {images_generated} images already conjured forth from the depths of imagination."
-                    )
-            else:
-                await update.message.reply_text(
-                    "Alas, no records of credit balance grace your account as of now. "
-                    "Craft your first masterpiece to activate your balance."
-                )
+            user_data = cache_balance(user_id, user_data.get("balance"), user_data.get("images_generated"))
+
+    if user_data and user_data.get("balance") is not None:
+        balance = user_data.get("balance")
+        images_generated = user_data.get("images_generated")
+        is_admin_user = is_super_user(user_id)
+
+        if is_admin_user:
+            await update.message.reply_text(
+                "Behold, as the master of this bot, you wield an infinite credit limit, "
+                "granting you boundless power within its realms."
+            )
         else:
             await update.message.reply_text(
-                "Alas, no records of credit balance grace your account as of now. "
-                "Craft your first masterpiece to activate your balance."
+                f"Behold, mortal! Your credit balance stands at ${balance:.2f}/10$, "
+                f"with {images_generated} images already conjured forth from the depths of imagination."
             )
+    else:
+        await update.message.reply_text(
+            "Alas, no records of credit balance grace your account as of now. "
+            "Craft your first masterpiece to activate your balance."
+        )
+
+
+async def show_usage(update: Update, _: ContextTypes.DEFAULT_TYPE):
+    """show images generated per day and spend to user"""
+    user_id = update.effective_user.id
+    conn = await db_connect()
+    try:
+        usage_rows = await conn.fetch(
+            "SELECT usage_date, images_generated, spend FROM user_usage_daily "
+            "WHERE user_id = $1 AND usage_date > CURRENT_DATE - $2::int ORDER BY usage_date DESC",
+            user_id, USAGE_DAYS
+        )
     finally:
         await conn.close()
 
+    if not usage_rows:
+        await update.message.reply_text(
+            f"Alas, no images have been conjured by you in the last {USAGE_DAYS} days.\n{USAGE_HISTORY_NOTE}"
+        )
+        return
+
+    lines = [
+        f"{row['usage_date']:%d/%m/%Y}: {row['images_generated']} images, ${row['spend']:.2f}"
+        for row in usage_rows
+    ]
+    total_images = sum(row["images_generated"] for row in usage_rows)
+    total_spend = sum(float(row["spend"]) for row in usage_rows)
+    await update.message.reply_text(
+        f"Behold, mortal! Your deeds of the last {USAGE_DAYS} days:\n" + "\n".join(lines) +
+        f"\nIn total: {total_images} images for ${total_spend:.2f}.\n{USAGE_HISTORY_NOTE}"
+    )
+
 
 def main():
     """Start the bot."""
@@ -342,7 +703,11 @@ def main():
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("balance", show_balance))
+    application.add_handler(CommandHandler("usage", show_usage))
+    application.add_handler(CommandHandler("image_options", show_image_options))
     application.add_handler(CallbackQueryHandler(switch_mode, pattern='^switch_to_(text|image)$'))
+    application.add_handler(CallbackQueryHandler(show_image_options, pattern='^image_options$'))
+    application.add_handler(CallbackQueryHandler(set_image_option, pattern='^image_(size|quality|n)_'))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     # application.run_polling(allowed_updates=Update.ALL_TYPES)
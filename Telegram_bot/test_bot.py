@@ -1,11 +1,32 @@
 """This module contains the unit tests for the telegram bot module."""
 
 import unittest
-from unittest.mock import AsyncMock, patch
-from Germes_theBot import check_openai_connection, save_user_to_db, switch_mode, show_balance, modes
+import asyncio
+import base64
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
+from datetime import date
+import Germes_theBot
+from Germes_theBot import (check_openai_connection, save_user_to_db, switch_mode, show_balance, show_usage, modes,
+                           cache_balance, route_chat_request, record_chat_stats, build_image_options_keyboard,
+                           USAGE_HISTORY_NOTE, load_chat_routes, answer_text_message,
+                           set_image_option, generate_images, answer_image_prompt)
 from telegram import Update, User, Message, Chat, CallbackQuery
 from telegram.ext import ContextTypes
 
+PRICES = {
+    ("1024x1024", "standard"): {"model": "dall-e-3", "price": 0.04},
+    ("1024x1024", "hd"): {"model": "dall-e-3", "price": 0.08},
+    ("512x512", "standard"): {"model": "dall-e-2", "price": 0.02},
+}
+
+def make_command_update(user_id):
+    """Build a mocked update for a command sent by the user."""
+    update = MagicMock()
+    update.effective_user.id = user_id
+    update.effective_chat.id = user_id
+    update.message.reply_text = AsyncMock()
+    return update
+
 class TestOpenAIConnection(unittest.TestCase):
     """Unit tests for checking the OpenAI connection."""
 
@@ -120,5 +141,355 @@ class TestShowBalance(unittest.TestCase):
             "with 3 images already conjured forth from the depths of imagination."
         )
 
+class TestShowBalanceCache(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for serving user balance from the balance cache."""
+
+    @patch('Germes_theBot.balance_cache', {})
+    @patch('Germes_theBot.db_connect', new_callable=AsyncMock)
+    async def test_show_balance_from_cache(self, mock_db_connect):
+        """Test showing user balance written through the cache without touching the database."""
+        cache_balance(123456, 2.5, 1)
+        update = make_command_update(123456)
+
+        await show_balance(update, None)
+        mock_db_connect.assert_not_called()
+        update.message.reply_text.assert_awaited_once_with(
+            "Behold, mortal! Your credit balance stands at $2.50/10$, "
+            "with 1 images already conjured forth from the depths of imagination."
+        )
+
+    @patch('Germes_theBot.balance_cache', {})
+    @patch('Germes_theBot.db_connect', new_callable=AsyncMock)
+    async def test_show_balance_fills_cache(self, mock_db_connect):
+        """Test reading the balance from the database once and answering later requests from the cache."""
+        mock_conn = AsyncMock()
+        mock_db_connect.return_value = mock_conn
+        mock_conn.fetchrow.return_value = {"user_id": 123456, "balance": 5.0, "images_generated": 3}
+
+        await show_balance(make_command_update(123456), None)
+        update = make_command_update(123456)
+        await show_balance(update, None)
+
+        mock_db_connect.assert_awaited_once()
+        update.message.reply_text.assert_awaited_once_with(
+            "Behold, mortal! Your credit balance stands at $5.00/10$, "
+            "with 3 images already conjured forth from the depths of imagination."
+        )
+
+    @patch('Germes_theBot.SUPER_USER_ID', "123456")
+    @patch('Germes_theBot.balance_cache', {})
+    async def test_show_balance_for_super_user(self):
+        """Test recognising the SUPER_USER_ID from the env (a string) as the numeric Telegram id."""
+        cache_balance(123456, 2.5, 1)
+        update = make_command_update(123456)
+
+        await show_balance(update, None)
+        update.message.reply_text.assert_awaited_once_with(
+            "Behold, as the master of this bot, you wield an infinite credit limit, "
+            "granting you boundless power within its realms."
+        )
+
+class TestRouteChatRequest(unittest.TestCase):
+    """Unit tests for routing chat requests."""
+
+    @patch('Germes_theBot.chat_stats', {})
+    def test_route_by_tier_and_prompt_size(self):
+        """Test picking routes by user tier and prompt length."""
+        self.assertEqual(route_chat_request("Hello!", "super")[0], "premium")
+        self.assertEqual(route_chat_request("Hello!", "allowed")[0], "standard")
+        self.assertEqual(route_chat_request("Hello! " * 1000, "allowed")[0], "long")
+        self.assertEqual(route_chat_request("Hello!", "guest")[0], "fast")
+
+    @patch('Germes_theBot.chat_stats', {})
+    def test_route_falls_back_on_failing_route(self):
+        """Test falling back to the fast route when the routed model keeps failing."""
+        for _ in range(5):
+            record_chat_stats("premium", 30.0, False)
+        self.assertEqual(route_chat_request("Hello!", "super")[0], "fast")
+
+    @patch('Germes_theBot.chat_stats', {})
+    def test_latency_limit_is_per_route(self):
+        """Test that long premium answers do not trip the latency limit of the fast route."""
+        for _ in range(5):
+            record_chat_stats("premium", 12.0, True)
+        self.assertEqual(route_chat_request("Hello!", "super")[0], "premium")
+
+    @patch('Germes_theBot.chat_stats', {})
+    def test_degraded_route_recovers_when_samples_expire(self):
+        """Test sending requests to a demoted route again once its samples are older than CHAT_STATS_MAX_AGE."""
+        for _ in range(5):
+            record_chat_stats("premium", 90.0, True)
+        self.assertEqual(route_chat_request("Hello!", "super")[0], "fast")
+        with patch('Germes_theBot.CHAT_STATS_MAX_AGE', -1):
+            self.assertEqual(route_chat_request("Hello!", "super")[0], "premium")
+
+class TestLoadChatRoutes(unittest.TestCase):
+    """Unit tests for loading the chat routes configuration."""
+
+    def test_partial_override_is_merged(self):
+        """Test that an override keeps the routes and keys it does not mention."""
+        routes = load_chat_routes('{"premium": {"model": "gpt-4o"}}')
+        self.assertEqual(routes["premium"]["model"], "gpt-4o")
+        self.assertEqual(routes["premium"]["max_tokens"], 2048)
+        self.assertEqual(set(routes), {"fast", "standard", "long", "premium"})
+
+    def test_incomplete_new_route_is_rejected(self):
+        """Test rejecting a new route that lacks required keys."""
+        with self.assertRaises(ValueError):
+            load_chat_routes('{"tiny": {"model": "gpt-3.5-turbo"}}')
+
+class TestAnswerTextMessage(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for answering text messages."""
+
+    def make_context(self):
+        """Build a mocked context that accepts chat actions."""
+        context = MagicMock()
+        context.bot.send_chat_action = AsyncMock()
+        return context
+
+    def make_response(self, content="Greetings"):
+        """Build a mocked chat completion response."""
+        response = MagicMock()
+        response.usage.prompt_tokens = 10
+        response.usage.completion_tokens = 20
+        response.choices[0].message.content = content
+        return response
+
+    @patch('Germes_theBot.chat_stats', {})
+    @patch('Germes_theBot.get_user_tier', new_callable=AsyncMock, return_value="guest")
+    @patch('Germes_theBot.client')
+    async def test_reply_error_is_not_a_model_failure(self, mock_client, _):
+        """Test that a failing Telegram reply is recorded only as a successful OpenAI call."""
+        mock_client.with_options.return_value.chat.completions.create.return_value = self.make_response()
+        update = make_command_update(123456)
+        update.message.reply_text.side_effect = RuntimeError("telegram is down")
+
+        await answer_text_message(update, self.make_context(), AsyncMock(), "Hello!")
+        self.assertEqual([ok for _, _, ok in Germes_theBot.chat_stats["fast"]], [True])
+
+    @patch('Germes_theBot.chat_stats', {})
+    @patch('Germes_theBot.get_user_tier', new_callable=AsyncMock, return_value="super")
+    @patch('Germes_theBot.client')
+    async def test_route_timeout_and_missing_usage(self, mock_client, _):
+        """Test using the route's own timeout and replying even when the response has no usage."""
+        response = self.make_response()
+        response.usage = None
+        mock_client.with_options.return_value.chat.completions.create.return_value = response
+        update = make_command_update(123456)
+
+        await answer_text_message(update, self.make_context(), AsyncMock(), "Hello!")
+        mock_client.with_options.assert_called_once_with(timeout=90, max_retries=0)
+        update.message.reply_text.assert_awaited_once_with("Greetings")
+
+    @patch('Germes_theBot.get_user_tier', new_callable=AsyncMock, side_effect=RuntimeError("db is down"))
+    async def test_tier_lookup_error_does_not_start_typing(self, _):
+        """Test that a failing tier lookup leaves no typing task behind."""
+        context = self.make_context()
+
+        with self.assertRaises(RuntimeError):
+            await answer_text_message(make_command_update(123456), context, AsyncMock(), "Hello!")
+        await asyncio.sleep(0)
+        context.bot.send_chat_action.assert_not_awaited()
+
+class TestImageOptionsKeyboard(unittest.TestCase):
+    """Unit tests for the image options keyboard."""
+
+    def test_build_image_options_keyboard(self):
+        """Test marking the chosen options and pricing all requested images."""
+        prices = {("512x512", "standard"): {"model": "dall-e-2", "price": 0.02}}
+        options = {"size": "512x512", "quality": "standard", "n": 4}
+
+        text, reply_markup = build_image_options_keyboard(options, prices)
+        self.assertIn("$0.08", text)
+        labels = [button.text for row in reply_markup.inline_keyboard for button in row]
+        self.assertIn("✓ 512x512", labels)
+        self.assertIn("✓ STANDARD", labels)
+        self.assertIn("✓ x4", labels)
+
+def make_image_response(count):
+    """Build a mocked OpenAI images response with the given number of images."""
+    response = MagicMock()
+    response.data = [MagicMock(b64_json=base64.b64encode(b"image").decode()) for _ in range(count)]
+    return response
+
+class TestSetImageOption(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for choosing image options on the keyboard."""
+
+    def make_callback_update(self, data):
+        """Build a mocked update for an image options button press."""
+        update = MagicMock()
+        update.effective_chat.id = 123456
+        update.callback_query.data = data
+        update.callback_query.answer = AsyncMock()
+        update.callback_query.edit_message_text = AsyncMock()
+        return update
+
+    @patch('Germes_theBot.image_options', {})
+    @patch('Germes_theBot.get_image_prices', new_callable=AsyncMock, return_value=PRICES)
+    @patch('Germes_theBot.db_connect', new_callable=AsyncMock)
+    async def test_set_image_count(self, *_):
+        """Test parsing the chosen image count."""
+        update = self.make_callback_update("image_n_4")
+
+        await set_image_option(update, None)
+        self.assertEqual(Germes_theBot.image_options[123456]["n"], 4)
+        update.callback_query.edit_message_text.assert_awaited_once()
+
+    @patch('Germes_theBot.image_options', {})
+    @patch('Germes_theBot.get_image_prices', new_callable=AsyncMock, return_value=PRICES)
+    @patch('Germes_theBot.db_connect', new_callable=AsyncMock)
+    async def test_reject_unpriced_combination(self, *_):
+        """Test rejecting a size and quality combination without a price."""
+        update = self.make_callback_update("image_size_512x512")
+        Germes_theBot.image_options[123456] = {"size": "1024x1024", "quality": "hd", "n": 1}
+
+        await set_image_option(update, None)
+        self.assertEqual(Germes_theBot.image_options[123456]["size"], "1024x1024")
+        update.callback_query.answer.assert_awaited_once_with(
+            "Alas, this combination of size and quality is not offered.")
+
+    @patch('Germes_theBot.image_options', {})
+    @patch('Germes_theBot.db_connect', new_callable=AsyncMock)
+    async def test_reject_unknown_values(self, mock_db_connect):
+        """Test rejecting crafted option values that are not offered on the keyboard."""
+        for data in ("image_n_50", "image_n_x", "image_size_4096x4096", "image_quality_ultra"):
+            update = self.make_callback_update(data)
+
+            await set_image_option(update, None)
+            update.callback_query.answer.assert_awaited_once_with("Alas, this option is not offered.")
+        self.assertEqual(Germes_theBot.image_options, {})
+        mock_db_connect.assert_not_called()
+
+class TestGenerateImages(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for generating image variants."""
+
+    @patch('Germes_theBot.client')
+    async def test_dall_e_2_uses_single_request(self, mock_client):
+        """Test requesting all dall-e-2 variants in one call."""
+        mock_client.images.generate.return_value = make_image_response(4)
+
+        images = await generate_images("cat", "dall-e-2", "512x512", "standard", 4)
+        self.assertEqual(images, [b"image"] * 4)
+        mock_client.images.generate.assert_called_once()
+        self.assertEqual(mock_client.images.generate.call_args.kwargs["n"], 4)
+
+    @patch('Germes_theBot.client')
+    async def test_dall_e_3_uses_one_request_per_image(self, mock_client):
+        """Test requesting dall-e-3 variants one by one and skipping the failed ones."""
+        mock_client.images.generate.side_effect = [make_image_response(1), RuntimeError("boom"),
+                                                   make_image_response(1)]
+
+        images = await generate_images("cat", "dall-e-3", "1024x1024", "hd", 3)
+        self.assertEqual(images, [b"image"] * 2)
+        self.assertEqual(mock_client.images.generate.call_count, 3)
+        for call in mock_client.images.generate.call_args_list:
+            self.assertEqual((call.kwargs["n"], call.kwargs["quality"]), (1, "hd"))
+
+    @patch('Germes_theBot.client')
+    async def test_dall_e_3_raises_when_all_fail(self, mock_client):
+        """Test raising when none of the dall-e-3 variants were generated."""
+        mock_client.images.generate.side_effect = RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            await generate_images("cat", "dall-e-3", "1024x1024", "standard", 2)
+
+class TestAnswerImagePrompt(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for answering prompts in image mode."""
+
+    def make_image_update(self):
+        """Build a mocked update for a prompt sent in image mode."""
+        update = make_command_update(123456)
+        update.message.reply_photo = AsyncMock()
+        update.message.reply_media_group = AsyncMock()
+        return update
+
+    async def answer(self, images, count, update=None, user_id=123456):
+        """Answer a prompt with the given generated images and return the update and the debit mock."""
+        conn = AsyncMock()
+        context = MagicMock()
+        context.bot.send_chat_action = AsyncMock()
+        update = update or self.make_image_update()
+        update.effective_user.id = user_id
+        conn.fetch.return_value = [{"user_id": user_id}]
+        options = {"size": "1024x1024", "quality": "standard", "n": count}
+        with patch('Germes_theBot.SUPER_USER_ID', "1"), \
+                patch('Germes_theBot.image_options', {123456: options}), \
+                patch('Germes_theBot.get_image_prices', new_callable=AsyncMock, return_value=PRICES), \
+                patch('Germes_theBot.has_image_credit', new_callable=AsyncMock, return_value=True), \
+                patch('Germes_theBot.generate_images', new_callable=AsyncMock, return_value=images), \
+                patch('Germes_theBot.debit_image_credit', new_callable=AsyncMock) as mock_debit:
+            await answer_image_prompt(update, context, conn, "cat")
+        return update, mock_debit
+
+    async def test_single_image_is_sent_as_photo(self):
+        """Test sending a single image with reply_photo."""
+        update, mock_debit = await self.answer([b"image"], 1)
+        update.message.reply_photo.assert_awaited_once()
+        update.message.reply_media_group.assert_not_awaited()
+        mock_debit.assert_awaited_once_with(ANY, 123456, 0.04, 1)
+
+    async def test_variants_are_sent_as_media_group_and_charged_when_delivered(self):
+        """Test sending the generated variants as one media group and charging for the delivered ones."""
+        update, mock_debit = await self.answer([b"image"] * 3, 4)
+        update.message.reply_photo.assert_not_awaited()
+        self.assertEqual(len(update.message.reply_media_group.await_args.kwargs["media"]), 3)
+        mock_debit.assert_awaited_once_with(ANY, 123456, 0.04, 3)
+
+    async def test_failed_delivery_is_not_charged(self):
+        """Test that images which could not be sent to the user are not charged."""
+        update = self.make_image_update()
+        update.message.reply_media_group.side_effect = RuntimeError("telegram is down")
+
+        update, mock_debit = await self.answer([b"image"] * 2, 2, update)
+        mock_debit.assert_not_awaited()
+        update.message.reply_text.assert_awaited_once_with("Sorry, there was an error delivering your image.")
+
+    async def test_super_user_is_not_charged(self):
+        """Test that the SUPER_USER_ID from the env (a string) matches the numeric Telegram id."""
+        update, mock_debit = await self.answer([b"image"] * 4, 4, user_id=1)
+        update.message.reply_media_group.assert_awaited_once()
+        mock_debit.assert_not_awaited()
+
+class TestShowUsage(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for showing user usage."""
+
+    @patch('Germes_theBot.USAGE_DAYS', 14)
+    @patch('Germes_theBot.db_connect', new_callable=AsyncMock)
+    async def test_show_usage(self, mock_db_connect):
+        """Test showing daily usage rolled up in the database."""
+        mock_conn = AsyncMock()
+        mock_db_connect.return_value = mock_conn
+        mock_conn.fetch.return_value = [
+            {"usage_date": date(2024, 4, 2), "images_generated": 2, "spend": 0.8},
+            {"usage_date": date(2024, 4, 1), "images_generated": 1, "spend": 0.4},
+        ]
+        update = make_command_update(123456)
+
+        await show_usage(update, None)
+        query, user_id, usage_days = mock_conn.fetch.await_args.args
+        self.assertIn("usage_date > CURRENT_DATE - $2::int", query)
+        self.assertEqual((user_id, usage_days), (123456, 14))
+        update.message.reply_text.assert_awaited_once_with(
+            "Behold, mortal! Your deeds of the last 14 days:\n"
+            "02/04/2024: 2 images, $0.80\n"
+            "01/04/2024: 1 images, $0.40\n"
+            "In total: 3 images for $1.20.\n" + USAGE_HISTORY_NOTE
+        )
+
+    @patch('Germes_theBot.USAGE_DAYS', 7)
+    @patch('Germes_theBot.db_connect', new_callable=AsyncMock)
+    async def test_show_usage_without_records(self, mock_db_connect):
+        """Test answering a user without usage records in the period."""
+        mock_conn = AsyncMock()
+        mock_db_connect.return_value = mock_conn
+        mock_conn.fetch.return_value = []
+        update = make_command_update(123456)
+
+        await show_usage(update, None)
+        update.message.reply_text.assert_awaited_once_with(
+            "Alas, no images have been conjured by you in the last 7 days.\n" + USAGE_HISTORY_NOTE
+        )
+        mock_conn.close.assert_awaited_once()
+
 if __name__ == '__main__':
     unittest.main()